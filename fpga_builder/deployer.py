@@ -48,7 +48,7 @@ from .utils import (
     err,
     print,
     XILINX_BIN_EXTENSION,
-    check_output,
+    check_output_argv,
     check_vitis,
 )
 
@@ -184,7 +184,7 @@ def get_current_branch(for_gitlab=False, cwd=None):
     if for_gitlab:
         branch = environ.get("CI_COMMIT_BRANCH")
     else:
-        branch = check_output("git branch --show-current", cwd=cwd)
+        branch = check_output_argv(["git", "branch", "--show-current"], cwd=cwd)
         branch = branch.strip().replace("\n", "")
     return branch
 
@@ -200,8 +200,7 @@ def get_current_commit_hash():
         The commit hash
 
     """
-    hash = check_output("git log --pretty=format:'%H' -n 1")
-    hash = hash.replace("'", "")
+    hash = check_output_argv(["git", "log", "--pretty=format:%H", "-n", "1"])
     return hash
 
 
@@ -216,7 +215,7 @@ def get_remote_url():
         The remote url in the form git@host:group/repo.git
 
     """
-    url = check_output("git config --get remote.origin.url")
+    url = check_output_argv(["git", "config", "--get", "remote.origin.url"])
     return url
 
 
@@ -231,7 +230,7 @@ def get_git_root_directory(cwd=None):
         The root directory
 
     """
-    path = check_output("git rev-parse --show-toplevel", cwd=cwd)
+    path = check_output_argv(["git", "rev-parse", "--show-toplevel"], cwd=cwd)
     return Path(path)
 
 
@@ -340,8 +339,7 @@ def verify_branch(this_dir, deploy_dir):
 
 
 def get_git_root_dir(dir):
-    cmd = "git rev-parse --show-toplevel"
-    output = check_output(cmd, cwd=dir)
+    output = check_output_argv(["git", "rev-parse", "--show-toplevel"], cwd=dir)
     return output
 
 
@@ -34,6 +34,9 @@ Utils for fpga build and deploy mechanism
 
 """
 
+import asyncio
+import os
+import selectors
 import subprocess
 from pathlib import Path
 import sys
@@ -46,10 +49,17 @@ except ImportError:
     print("Colorama not present, falling back to no color")
     HAS_COLORAMA = False
 import shlex
-import inspect
+import functools
 
 if HAS_COLORAMA:
     colorama_init(strip=False)
+    _ERR_PREFIX = Fore.RED + Style.BRIGHT
+    _CRITICAL_WARNING_PREFIX = Fore.MAGENTA + Style.BRIGHT
+    _WARNING_PREFIX = Fore.YELLOW
+    _INFO_PREFIX = Fore.RESET
+    _SUCCESS_PREFIX = Fore.GREEN
+    _RESET_SUFFIX = Fore.RESET + Style.RESET_ALL
+    _SUCCESS_SUFFIX = Fore.RESET + "\n"
 
 FILE_DIR = Path(__file__).parent.absolute()
 
@@ -57,6 +67,18 @@ default_print = print
 
 XILINX_BIN_EXTENSION = ".bat" if sys.platform == "win32" else ""
 
+# Flush every print when someone is watching, otherwise let logs buffer
+# Set FPGA_BUILDER_FLUSH=1 to always flush
+_FLUSH = os.environ.get("FPGA_BUILDER_FLUSH") == "1" or (
+    sys.stdout is not None and sys.stdout.isatty()
+)
+
+# How much command output to read at a time
+_READ_CHUNK_SIZE = 65536
+
+# Most changed files repo_clean will list when the repo is dirty
+_REPO_DIRTY_MAX_ENTRIES = 20
+
 
 def run_cmd(cmd, cwd=None, silent=False, line_handler=None, blocking=True):
     """
@@ -64,7 +86,7 @@ def run_cmd(cmd, cwd=None, silent=False, line_handler=None, blocking=True):
     Throws an exception if return code was non zero
 
     Args:
-        cmd:          The command to run
+        cmd:          The command to run, either a string or a list of its arguments
         cwd:          The directory to execute from, set to cwd if None
         silent:       When true, does not print out what command it's running
         line_handler: Function of a string that is each line.  If not provided, just prints output
@@ -75,113 +97,332 @@ def run_cmd(cmd, cwd=None, silent=False, line_handler=None, blocking=True):
     """
     if not cwd:
         cwd = Path.cwd()
+    cmd, split_cmd = _split_cmd(cmd)
+    if not silent:
+        _print_cmd_header(cmd, cwd)
+    if not blocking:
+        return _run_nonblocking(cmd, split_cmd, cwd)
+    rc = _run_blocking(cmd, split_cmd, cwd, line_handler)
+    if rc != 0:
+        raise Exception(_cmd_failed_msg(cmd, cwd, rc))
+    if not silent:
+        _print_cmd_footer()
+    return rc
 
-    def err_msg(p):
-        return f"""
-      command: {cmd}
-      cwd:     {cwd}
-      rc:      {p.returncode}
+
+async def run_cmd_async(cmd, cwd=None, silent=False, line_handler=None):
     """
+    Same as a blocking run_cmd, but as a coroutine
+    Lets independent commands run at the same time, e.g. with asyncio.gather
+    Throws an exception if return code was non zero
+
+    Args:
+        cmd:          The command to run, either a string or a list of its arguments
+        cwd:          The directory to execute from, set to cwd if None
+        silent:       When true, does not print out what command it's running
+        line_handler: Function of a string that is each line.  If not provided, just prints output
 
+    Returns:
+        The return code of the command
+    """
+    if not cwd:
+        cwd = Path.cwd()
+    cmd, split_cmd = _split_cmd(cmd)
     if not silent:
-        print()
-        print("=============================================================")
-        print("Running command:")
-        print(cmd)
-        print(f"From directory {cwd}")
-
-    cmd = cmd.replace("\\", "\\\\")
-    split_cmd = shlex.split(cmd)
-    if blocking:
-        stdout = subprocess.PIPE
-        stderr = subprocess.STDOUT
-        close_fds = False
-        shell = False
-    else:
-        # TODO See if there's a better way to do this
-        stdout = None
-        stderr = None
-        close_fds = True
-        shell = True
+        _print_cmd_header(cmd, cwd)
+    if not line_handler:
+        # Print line by line so output from commands running together doesn't get mixed up
+        line_handler = print
     try:
-        process = subprocess.Popen(
-            split_cmd,
-            stdout=stdout,
-            stderr=stderr,
+        process = await asyncio.create_subprocess_exec(
+            *split_cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
             cwd=cwd,
-            close_fds=close_fds,
-            shell=shell,
         )
     except (FileNotFoundError, OSError) as e:
-        err(f"Command was {cmd}")
-        err(f"Split command was {split_cmd}")
+        _launch_failed(cmd, split_cmd)
         raise (e)
-    if not blocking:
-        return 0
-    while process.poll() is None:
-        output = process.stdout.readline()
-        if output:
-            line = output.decode("utf-8").strip()
-            if line_handler:
-                # Specific runners can handle fancy printing with colors and stuff
-                line_handler(line)
-            else:
-                # Otherwise fall back to regular printing
-                print(line)
-    rc = process.poll()
+    try:
+        pending = b""
+        while True:
+            chunk = await process.stdout.read(_READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            pending = _dispatch_lines(pending + chunk, line_handler)
+        if pending:
+            line_handler(_decode_line(pending))
+        rc = await process.wait()
+    except BaseException:
+        # Cancelled, e.g. another command in a gather failed, don't leave this one running
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        raise
     if rc != 0:
-        raise Exception(err_msg(process))
+        raise Exception(_cmd_failed_msg(cmd, cwd, rc))
     if not silent:
-        print("=============================================================")
+        _print_cmd_footer()
     return rc
 
 
-def err(*args, **kwargs):
-    if HAS_COLORAMA:
-        print(Fore.RED + Style.BRIGHT, end="")
-    print(*args, **kwargs)
-    if HAS_COLORAMA:
-        print(Fore.RESET + Style.RESET_ALL, end="")
+def _print_cmd_header(cmd, cwd):
+    print()
+    print("=============================================================")
+    print("Running command:")
+    print(cmd)
+    print(f"From directory {cwd}")
+
+
+def _print_cmd_footer():
+    print("=============================================================")
+
+
+def _cmd_failed_msg(cmd, cwd, rc):
+    return f"""
+      command: {cmd}
+      cwd:     {cwd}
+      rc:      {rc}
+    """
+
+
+def _split_cmd(cmd):
+    """
+    Splits a command into its arguments, unless it already is
+
+    Args:
+        cmd: The command string, or a list of its arguments
+
+    Returns:
+        The command as a string for printing, and the list of its arguments
+    """
+    if isinstance(cmd, str):
+        to_split = cmd
+        if sys.platform == "win32" and "\\" in cmd:
+            # Keep shlex from treating the backslashes in windows paths as escapes
+            to_split = cmd.replace("\\", "\\\\")
+        return cmd, shlex.split(to_split)
+    split_cmd = [str(arg) for arg in cmd]
+    return shlex.join(split_cmd), split_cmd
+
+
+def _popen(cmd, split_cmd, **kwargs):
+    """
+    Starts the split command, reporting what was attempted if it can't be launched
+
+    Args:
+        cmd:       The command as provided, for error reporting
+        split_cmd: The command split into its arguments
+        kwargs:    Passed straight through to subprocess.Popen
+
+    Returns:
+        The started Popen object
+    """
+    try:
+        return subprocess.Popen(split_cmd, **kwargs)
+    except (FileNotFoundError, OSError) as e:
+        _launch_failed(cmd, split_cmd)
+        raise (e)
+
+
+def _launch_failed(cmd, split_cmd):
+    err(f"Command was {cmd}")
+    err(f"Split command was {split_cmd}")
+
+
+def _run_nonblocking(cmd, split_cmd, cwd):
+    """
+    Starts the split command and leaves it running in the background
+
+    Args:
+        cmd:       The command as provided, for error reporting
+        split_cmd: The command split into its arguments
+        cwd:       The directory to execute from
+
+    Returns:
+        0
+    """
+    # Don't hand over our stdout/stderr, they'd be held open for as long as it runs
+    _popen(
+        cmd,
+        split_cmd,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        cwd=cwd,
+        close_fds=True,
+    )
+    return 0
+
+
+def _run_blocking(cmd, split_cmd, cwd, line_handler):
+    """
+    Runs the split command to completion, passing each line of output to line_handler
+
+    Output is read in large chunks and split into lines here rather than with a
+    readline per line, tools like vivado can produce an awful lot of output
+
+    Args:
+        cmd:          The command as provided, for error reporting
+        split_cmd:    The command split into its arguments
+        cwd:          The directory to execute from
+        line_handler: Function of a string that is each line.  If None, just prints output
+
+    Returns:
+        The return code of the command
+    """
+    if not line_handler:
+        # Otherwise fall back to regular printing
+        line_handler = print
+    process = _popen(
+        cmd, split_cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=cwd
+    )
+    pending = b""
+
+    def handle_chunk(chunk):
+        nonlocal pending
+        pending = _dispatch_lines(pending + chunk, line_handler)
+
+    # Read the pipe directly, there's no need for the file object's buffering and locking
+    fd = process.stdout.fileno()
+    if not _read_until_exit(process, fd, handle_chunk):
+        # No pidfd support, just read until the pipe closes
+        while True:
+            chunk = os.read(fd, _READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            handle_chunk(chunk)
+    if pending:
+        line_handler(_decode_line(pending))
+    return process.wait()
+
+
+def _read_until_exit(process, fd, handle_chunk):
+    """
+    Passes output from the process to handle_chunk until the process exits
+
+    Waits on a pidfd for the process alongside its stdout, so the exit is seen
+    as soon as it happens, even if something the process spawned is still
+    holding the pipe open
+
+    Args:
+        process:      The Popen object to wait on
+        fd:           The file descriptor of its stdout
+        handle_chunk: Function of each chunk of bytes read
+
+    Returns:
+        False if pidfds aren't supported here and nothing was read, otherwise True
+    """
+    if not hasattr(os, "pidfd_open"):
+        return False
+    try:
+        pidfd = os.pidfd_open(process.pid)
+    except OSError:
+        # Kernel is too old
+        return False
+    try:
+        with selectors.DefaultSelector() as selector:
+            selector.register(fd, selectors.EVENT_READ)
+            selector.register(pidfd, selectors.EVENT_READ)
+            exited = False
+            while not exited:
+                for key, _ in selector.select():
+                    if key.fd == pidfd:
+                        exited = True
+                        continue
+                    chunk = os.read(fd, _READ_CHUNK_SIZE)
+                    if chunk:
+                        handle_chunk(chunk)
+                    else:
+                        selector.unregister(fd)
+    finally:
+        os.close(pidfd)
+    # Pick up whatever was left in the pipe without waiting on anyone else holding it
+    os.set_blocking(fd, False)
+    try:
+        while True:
+            chunk = os.read(fd, _READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            handle_chunk(chunk)
+    except BlockingIOError:
+        pass
+    return True
+
+
+def _dispatch_lines(data, line_handler):
+    """
+    Passes each complete line in data to line_handler
+
+    Args:
+        data:         Bytes of output, possibly ending partway through a line
+        line_handler: Function of a string that is each line
+
+    Returns:
+        The trailing partial line, to be prepended to the next chunk
+    """
+    *lines, pending = data.split(b"\n")
+    for line in lines:
+        line_handler(_decode_line(line))
+    return pending
+
+
+def _decode_line(line):
+    return line.decode("utf-8", errors="replace").strip()
 
 
-def critical_warning(*args, **kwargs):
-    if HAS_COLORAMA:
-        print(Fore.MAGENTA + Style.BRIGHT, end="")
-    print(*args, **kwargs)
-    if HAS_COLORAMA:
-        print(Fore.RESET + Style.RESET_ALL, end="")
+def _err_color(*args, **kwargs):
+    _color_print(_ERR_PREFIX, _RESET_SUFFIX, *args, **kwargs)
 
 
-def warning(*args, **kwargs):
-    if HAS_COLORAMA:
-        print(Fore.YELLOW, end="")
-    print(*args, **kwargs)
-    if HAS_COLORAMA:
-        print(Fore.RESET + Style.RESET_ALL, end="")
+def _critical_warning_color(*args, **kwargs):
+    _color_print(_CRITICAL_WARNING_PREFIX, _RESET_SUFFIX, *args, **kwargs)
 
 
-def info(*args, **kwargs):
+def _warning_color(*args, **kwargs):
+    _color_print(_WARNING_PREFIX, _RESET_SUFFIX, *args, **kwargs)
+
+
+def _info_color(*args, **kwargs):
     # In case we want info colors later?
-    if HAS_COLORAMA:
-        print(Fore.RESET, end="")
-    print(*args, **kwargs)
-    if HAS_COLORAMA:
-        print(Fore.RESET + Style.RESET_ALL, end="")
+    _color_print(_INFO_PREFIX, _RESET_SUFFIX, *args, **kwargs)
+
+
+def _success_color(*args, **kwargs):
+    _color_print(_SUCCESS_PREFIX, _SUCCESS_SUFFIX, *args, **kwargs)
 
 
-def success(*args, **kwargs):
-    if HAS_COLORAMA:
-        print(Fore.GREEN, end="")
-    print(*args, **kwargs)
-    if HAS_COLORAMA:
-        print(Fore.RESET)
+def _color_print(prefix, suffix, *args, sep=None, end=None, **kwargs):
+    """
+    Prints the args wrapped in the color codes in a single write
+
+    Args:
+        prefix: Color codes to go before the message
+        suffix: Color codes to go after the message, including its line ending
+        args:   What to print
+        kwargs: Same as print
+    """
+    sep = " " if sep is None else sep
+    end = "\n" if end is None else end
+    print(prefix + sep.join(map(str, args)) + end + suffix, end="", **kwargs)
 
 
 def print(*args, **kwargs):
-    kwargs["flush"] = True
+    kwargs.setdefault("flush", _FLUSH)
     default_print(*args, **kwargs)
 
 
+# Pick the logging functions once rather than checking for color on every call
+if HAS_COLORAMA:
+    err = _err_color
+    critical_warning = _critical_warning_color
+    warning = _warning_color
+    info = _info_color
+    success = _success_color
+else:
+    # Nothing to color, straight to print
+    err = critical_warning = warning = info = success = print
+
+
 def caller_dir():
     """
     Returns the directory of the file that called into the **current context**
@@ -194,10 +435,14 @@ def caller_dir():
 
     """
     # Use the second one up since calling this will invoke another stack frame
-    frame = inspect.stack()[2]
-    filename = frame[0].f_code.co_filename
-    dir = Path(filename).resolve().parent
-    return dir
+    filename = sys._getframe(2).f_code.co_filename
+    return _file_dir(filename)
+
+
+@functools.lru_cache(maxsize=None)
+def _file_dir(filename):
+    # Resolved since callers go up from here, only costs the filesystem walk once per file
+    return Path(filename).resolve().parent
 
 
 def repo_clean():
@@ -211,10 +456,8 @@ def repo_clean():
         True if the repo is in a clean state
 
     """
-    cmd = "git status --porcelain"
-    output = subprocess.run(cmd, capture_output=True, shell=True).stdout
-    if output:
-        output = cmd + "\n" + output.decode("utf-8")
+    clean, output = _git_status_clean()
+    if not clean:
         # This git command should be empty if everything is good to go
         if "DEBUG_ALLOW_GIT_DIRTY" in globals():
             # Provide dev option to bypass check
@@ -223,9 +466,54 @@ def repo_clean():
             print("**** WARNING: Bypassing git clean check ****")
             print("********************************************")
             return globals()["DEBUG_ALLOW_GIT_DIRTY"], output
-        else:
-            return False, output
-    return True, ""
+    return clean, output
+
+
+def _git_status_clean():
+    """
+    Runs git status in the current directory to check for changes
+
+    Returns:
+        True if there are no changes, along with a summary of the changes found
+        Only the first _REPO_DIRTY_MAX_ENTRIES changes are listed, as "XY path"
+    """
+    cmd = "git status --porcelain=v2 --no-renames --untracked-files=normal"
+    process = subprocess.Popen(
+        shlex.split(cmd), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+    )
+    entries = []
+    with process:
+        for entry in process.stdout:
+            if len(entries) == _REPO_DIRTY_MAX_ENTRIES:
+                # Enough to show what's going on, don't wait for git to list everything
+                process.terminate()
+                entries.append("...")
+                break
+            entries.append(_format_status_entry(entry.decode("utf-8").rstrip("\n")))
+    if not entries:
+        return True, ""
+    return False, "Changes found by git status:\n" + "\n".join(entries) + "\n"
+
+
+def _format_status_entry(entry):
+    """
+    Shortens a porcelain v2 status entry to just its status and path
+
+    Args:
+        entry: A line of `git status --porcelain=v2` output
+
+    Returns:
+        The entry as "XY path", untracked and ignored entries are returned as is
+    """
+    # Changed entries have 9 fields, unmerged have 11, and the path is last
+    num_fields = {"1": 9, "u": 11}.get(entry[:1])
+    if num_fields is None:
+        return entry
+    fields = entry.split(" ", num_fields - 1)
+    return f"{fields[1]} {fields[-1]}"
+
+
+_YESNO_VALID = {"yes": True, "y": True, "ye": True, "no": False, "n": False}
 
 
 # https://stackoverflow.com/questions/3041986/apt-command-line-interface-like-yes-no-input
@@ -239,7 +527,6 @@ def query_yes_no(question, default="yes", print_func=None):
 
     The "answer" return value is True for "yes" or False for "no".
     """
-    valid = {"yes": True, "y": True, "ye": True, "no": False, "n": False}
     if default is None:
         prompt = " [y/n] "
     elif default == "yes":
@@ -252,25 +539,50 @@ def query_yes_no(question, default="yes", print_func=None):
     if print_func is None:
         print_func = print
 
+    prompt_line = f"{question} {prompt}"
+    interactive = sys.stdin.isatty()
     while True:
-        print_func(f"{question} {prompt}", end="")
-        choice = input().lower()
-        if default is not None and choice == "":
-            return valid[default]
-        elif choice in valid:
-            return valid[choice]
+        print_func(prompt_line, end="")
+        if interactive:
+            choice = input()
         else:
-            print_func("Please respond with 'yes' or 'no' " "(or 'y' or 'n').", end="")
+            # No one to give line editing to, skip input()'s extra work
+            sys.stdout.flush()
+            choice = sys.stdin.readline()
+            if not choice:
+                raise EOFError("EOF when reading a line")
+        choice = choice.strip().lower()
+        if default is not None and choice == "":
+            return _YESNO_VALID[default]
+        answer = _YESNO_VALID.get(choice)
+        if answer is not None:
+            return answer
+        print_func("Please respond with 'yes' or 'no' " "(or 'y' or 'n').", end="")
 
 
 def check_output(cmd, cwd=None):
-    return subprocess.check_output(shlex.split(cmd), cwd=cwd).decode().strip()
+    return _decode_output(check_output_bytes(cmd, cwd=cwd))
+
+
+def check_output_bytes(cmd, cwd=None):
+    return subprocess.check_output(shlex.split(cmd), cwd=cwd)
+
+
+def check_output_argv(argv, cwd=None):
+    return _decode_output(subprocess.check_output(argv, cwd=cwd))
+
+
+def _decode_output(output):
+    # Strip before decoding so there's only the one new string
+    return output.strip().decode("utf-8", errors="replace")
 
 
 # check version to see if Vitis or SDK is being used
+@functools.lru_cache(maxsize=None)
 def check_vitis(version):
     ver_parts = version.split(".")
-    if int(ver_parts[0]) <= 2019 and int(ver_parts[1]) <= 1:
-        return 0
-    else:
+    # Vitis replaced SDK after 2019.1
+    if (int(ver_parts[0]), int(ver_parts[1])) > (2019, 1):
         return 1
+    else:
+        return 0